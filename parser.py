@@ -2,11 +2,43 @@
 
 """AVM URLADER parser"""
 
+import mmap
+import struct
+
 DEBUG = False
 
+# upper bound for reading devices that cannot be mapped, urlader partitions are smaller
+MAX_URLADER_SIZE = 0x100000
+
+
+def endian_structs(fmt):
+    """Precompile struct format for both endianesses"""
+    return {"big": struct.Struct(f">{fmt}"), "little": struct.Struct(f"<{fmt}")}
+
+
+UINT32 = endian_structs("I")
+POINTER = endian_structs("II")
+# memsize, flashsize, 2 unused, 6 mtd (start, size), 2 unknown, last data position
+HEADER_V2 = endian_structs("19I")
+# memsize, flashsize, 5 mtd (start, size), 14 unknown, end of struct
+HEADER_V3 = endian_structs("27I")
+MTD_KEYS = tuple((f"mtd{i}_start", f"mtd{i}_length") for i in range(6))
+
+# (endianess, offset) candidates for the urlader version, checked in order
+VERSION_PROBES = (("big", 0x580), ("little", 0x580))
+MAX_VERSION = 5
+
+# keys whose integer values are printed as hex strings
+HEX_KEY_SUFFIXES = ("_start", "_length")
+HEX_KEY_PREFIXES = ("unknown",)
+HEX_KEYS = ("struct_end", "last_data_position")
+
 
 def debug(string):
-    """debug log"""
+    """debug log
+    Hot call sites check DEBUG before calling to skip formatting the message,
+    the check here keeps other callers from printing into the JSON output
+    """
     if DEBUG:
         print(string)
 
@@ -40,35 +72,37 @@ def parse_urlader_v2(urlader, endianess, offset):
     0x??+4  0x0000 0000 (one before "end of pointer list")
     0x??+8  0xffff ffff ("end of data pointer")
     0x??+x  more 0xffff padding until first variable's value
+
+    Returns None if the urlader is too short for the header
     """
-    offset_memsize = offset + 0x24
+    header_struct = HEADER_V2[endianess]
+    if len(urlader) < offset + 0x24 + header_struct.size:
+        return None
+    header = header_struct.unpack_from(urlader, offset + 0x24)
+    pos = offset + 0x24 + header_struct.size
 
     variables = {}
-    urlader.seek(offset_memsize)
-    variables["memsize"] = read_integer(urlader, endianess)
-    variables["flashsize"] = read_integer(urlader, endianess)
-    variables["unused1"] = read_integer(urlader, endianess)
-    variables["unused2"] = read_integer(urlader, endianess)
-    for i in range(0, 6):
-        mtd_name = f"mtd{i}"
-        variables[f"{mtd_name}_start"] = hex(read_integer(urlader, endianess))
-        variables[f"{mtd_name}_length"] = hex(read_integer(urlader, endianess))
-    variables["unknown_data1"] = hex(read_integer(urlader, endianess))
-    variables["unknown_data2"] = hex(read_integer(urlader, endianess))
-
-    last_data_position = read_integer(urlader, endianess)
-    variables["last_data_position"] = hex(last_data_position)
+    variables["memsize"] = header[0]
+    variables["flashsize"] = header[1]
+    variables["unused1"] = header[2]
+    variables["unused2"] = header[3]
+    mtd_table = header[4:16]
+    variables.update(parse_mtd_table(mtd_table))
+    variables["unknown_data1"] = header[16]
+    variables["unknown_data2"] = header[17]
+
+    last_data_position = header[18]
+    variables["last_data_position"] = last_data_position
 
     # mtd2 is the urlader device
-    mtd2_offset = int(variables["mtd2_start"], 0)
+    mtd2_offset = mtd_table[4]
     relative_last_data_position = last_data_position - mtd2_offset
 
-    pointers = read_variable_pointers(urlader, endianess, relative_last_data_position)
+    pointers = read_variable_pointers(
+        urlader, pos, endianess, relative_last_data_position
+    )
 
-    for pointer in pointers:
-        name = read_string(urlader, pointer["name"] - mtd2_offset)
-        value = read_string(urlader, pointer["value"] - mtd2_offset)
-        variables[name] = value
+    variables.update(read_variables(urlader, pointers, mtd2_offset))
 
     return variables
 
@@ -100,111 +134,193 @@ def parse_urlader_v3(urlader, endianess, offset):
     0x??+4  0x0000 0000 (one before "end of pointer list")
     0x??+8  0xffff ffff ("end of data pointer")
     0x??+x  more 0xffff padding until first variable's value
+
+    Returns None if the urlader is too short for the header
     """
-    offset_end_of_struct = offset + 0x6C
+    header_struct = HEADER_V3[endianess]
+    if len(urlader) < offset + 0x4 + header_struct.size:
+        return None
+    header = header_struct.unpack_from(urlader, offset + 0x4)
+    pos = offset + 0x4 + header_struct.size
 
     variables = {}
-    variables["memsize"] = hex(read_integer(urlader, endianess))
-    variables["flashsize"] = hex(read_integer(urlader, endianess))
-    for postfix in range(0, 5):
-        mtd_name = f"mtd{postfix}"
-        variables[f"{mtd_name}_start"] = hex(read_integer(urlader, endianess))
-        variables[f"{mtd_name}_length"] = hex(read_integer(urlader, endianess))
+    variables["memsize"] = hex(header[0])
+    variables["flashsize"] = hex(header[1])
+    mtd_table = header[2:12]
+    variables.update(parse_mtd_table(mtd_table))
 
-    while urlader.tell() < offset_end_of_struct:
-        pos = urlader.tell()  # no walrus operator to make Black happy
-        variables[f"unknown{hex(pos)}"] = hex(read_integer(urlader, endianess))
+    # unknown values up to the end of struct at offset + 0x6C
+    for index, value in enumerate(header[12:-1]):
+        variables[f"unknown{hex(offset + 0x34 + index * 4)}"] = value
 
-    struct_end = read_integer(urlader, endianess)
-    variables["struct_end"] = hex(struct_end)
+    struct_end = header[-1]
+    variables["struct_end"] = struct_end
 
-    mtd2_offset = int(variables["mtd2_start"], 0)
+    mtd2_offset = mtd_table[4]
     relative_last_data_position = struct_end - mtd2_offset
 
-    pointers = read_variable_pointers(urlader, endianess, relative_last_data_position)
+    pointers = read_variable_pointers(
+        urlader, pos, endianess, relative_last_data_position
+    )
+
+    variables.update(read_variables(urlader, pointers, mtd2_offset))
+
+    return variables
 
-    for pointer in pointers:
-        name = read_string(urlader, pointer["name"] - mtd2_offset)
-        value = read_string(urlader, pointer["value"] - mtd2_offset)
-        variables[name] = value
+
+def parse_mtd_table(mtd_table):
+    """Parse list of alternating mtd start and length values"""
+    variables = {}
+    for (start_key, length_key), start, length in zip(
+        MTD_KEYS, mtd_table[::2], mtd_table[1::2]
+    ):
+        variables[start_key] = start
+        variables[length_key] = length
 
     return variables
 
 
-def read_variable_pointers(urlader, endianess, relative_last_data_position):
-    """Read list of variable pointers"""
-    pointers = []
-    while urlader.tell() < relative_last_data_position:
-        value = urlader.read(4)
-        name = urlader.read(4)
-        if value == b"\x00\x00\x00\x00" and name == b"\x00\x00\x00\x00":
-            debug(f"Found end of variables at {hex(urlader.tell())}")
-            break
-
-        pointers.append(
-            {
-                "value": int.from_bytes(value, endianess),
-                "name": int.from_bytes(name, endianess),
-            }
-        )
-    debug(f"List of pointers: {pointers}")
+def read_variable_pointers(urlader, position, endianess, relative_last_data_position):
+    """Read list of variable pointers
+    Returns (value, name) tuples up to the first all-zero entry
+    """
+    pointer_struct = POINTER[endianess]
+    # Round up to whole entries, the last entry may cross the data position
+    count = -(-(relative_last_data_position - position) // pointer_struct.size)
+    block = urlader[position : position + max(count, 0) * pointer_struct.size]
+    end = len(block) - len(block) % pointer_struct.size
+
+    # Find the all-zero terminating entry, ignoring matches not aligned to entries
+    terminator = bytes(pointer_struct.size)
+    index = block.find(terminator, 0, end)
+    while index >= 0 and index % pointer_struct.size:
+        index = block.find(terminator, index + 1, end)
+    if index >= 0:
+        end = index
+        if DEBUG:
+            debug(f"Found end of variables at {hex(position + index)}")
+
+    pointers = list(pointer_struct.iter_unpack(block[:end]))
+    if DEBUG:
+        debug(f"List of pointers: {pointers}")
 
     return pointers
 
 
+def read_variables(urlader, pointers, mtd_offset):
+    """Resolve variable pointers to their name and value strings"""
+    variables = {}
+    for value_pointer, name_pointer in pointers:
+        name = read_string(urlader, name_pointer - mtd_offset)
+        value = read_string(urlader, value_pointer - mtd_offset)
+        variables[name] = value
+
+    return variables
+
+
 def read_string(urlader, position):
     """Read NULL terminated string
-    Reads bytes until NULL marker has been found
+    Scans for the NULL marker starting at the given position
+    """
+    if DEBUG:
+        debug(f"Parsing string at {hex(position)}")
+    if not 0 <= position < len(urlader):
+        raise ValueError(f"String pointer {hex(position)} is outside of urlader")
+    end = urlader.find(b"\x00", position)
+    if end < 0:
+        end = len(urlader)
+    return urlader[position:end].decode("utf-8")
+
+
+def read_integer(urlader, position, endianess):
+    """Read 4 bytes at position with specified endianess
+    Returns 0 if the urlader ends before, like the file based reads did
+    """
+    if DEBUG:
+        debug(f"Reading integer at {hex(position)}")
+    if len(urlader) < position + UINT32[endianess].size:
+        return 0
+    return UINT32[endianess].unpack_from(urlader, position)[0]
+
+
+def load_urlader(urlader):
+    """Map urlader file into memory
+    Falls back to reading at most MAX_URLADER_SIZE bytes for devices that cannot
+    be mapped, e.g. MTD character devices which report a size of 0
     """
-    debug(f"Parsing string at {hex(position)}")
-    urlader.seek(position)
-    full_data = b""
-    data = urlader.read(1)
-    # Read until the 0x00 marker
-    while data != b"\x00":
-        full_data = full_data + data
-        data = urlader.read(1)
+    try:
+        return mmap.mmap(urlader.fileno(), 0, access=mmap.ACCESS_READ)
+    except (ValueError, OSError):
+        return urlader.read(MAX_URLADER_SIZE)
 
-    return full_data.decode("utf-8")
 
+def identify_urlader(urlader):
+    """Identify endianess, offset and version of the urlader
+    Returns the first probe with a plausible version, defaulting to the first one
+    """
+    probes = [
+        (endianess, offset, read_integer(urlader, offset, endianess))
+        for endianess, offset in VERSION_PROBES
+    ]
+    for probe in probes:
+        if probe[2] <= MAX_VERSION:
+            return probe
 
-def read_integer(urlader, endianess):
-    """Read next 4 bytes with specified endianess"""
-    debug(f"Reading integer at {hex(urlader.tell())}")
-    return int.from_bytes(urlader.read(4), endianess)
+    return probes[0]
 
 
 def parse_urlader(filepath):
     """parse urlader file"""
-    endianess = "big"
-    offset_start = 0x580
     variables = {}
 
-    with open(filepath, "rb") as urlader:
-        urlader.seek(offset_start)
-        version = urlader.read(4)
-        variables["version"] = int.from_bytes(version, endianess)
+    with open(filepath, "rb") as file:
+        urlader = load_urlader(file)
+
+    try:
+        endianess, offset_start, version = identify_urlader(urlader)
+        if DEBUG:
+            debug(f"Found {endianess} endian urlader at {hex(offset_start)}")
+        variables["version"] = version
         if variables["version"] == 2:
-            variables = {
-                **variables,
-                **parse_urlader_v2(urlader, endianess, offset_start),
-            }
+            parsed = parse_urlader_v2(urlader, endianess, offset_start)
         elif variables["version"] == 3:
-            variables = {
-                **variables,
-                **parse_urlader_v3(urlader, endianess, offset_start),
-            }
+            parsed = parse_urlader_v3(urlader, endianess, offset_start)
         else:
             print(f"ERROR: Unsupported urlader version { version }")
             return variables
 
+        if parsed is None:
+            print(f"ERROR: urlader too short for version { version } header")
+            return variables
+        variables.update(parsed)
+    finally:
+        if isinstance(urlader, mmap.mmap):
+            urlader.close()
+
     return variables
 
 
+def format_variables(variables):
+    """Format offsets and sizes in variables as hex strings for output"""
+    return {key: format_value(key, value) for key, value in variables.items()}
+
+
+def format_value(key, value):
+    """Format integer value as hex string if key is an offset or size"""
+    if isinstance(value, int) and (
+        key in HEX_KEYS
+        or key.endswith(HEX_KEY_SUFFIXES)
+        or key.startswith(HEX_KEY_PREFIXES)
+    ):
+        return hex(value)
+    return value
+
+
 if __name__ == "__main__":
     import sys
     import json
 
     FILEPATH = sys.argv[1]
-    debug(f"Parsing {FILEPATH}")
-    print(json.dumps(parse_urlader(FILEPATH), indent=4))
+    if DEBUG:
+        debug(f"Parsing {FILEPATH}")
+    print(json.dumps(format_variables(parse_urlader(FILEPATH)), indent=4))